@@ -1,19 +1,53 @@
+import asyncio
 import datetime
 import logging.config
 from environs import Env
 from seller import download_stock
 
+import aiohttp
+import orjson
 import requests
 
-from seller import divide, price_conversion
+from seller import (
+    CONCURRENCY_LIMIT,
+    AsyncRateLimiter,
+    create_api_session,
+    divide,
+    forget_delisted,
+    gather_or_cancel,
+    load_uploaded,
+    prices_conversion,
+    retry_on_throttle,
+    save_uploaded,
+    stocks_conversion,
+)
 
 logger = logging.getLogger(__file__)
 
+# Заголовки запросов к API Маркета, общие для всех методов.
+MARKET_HEADERS = {
+    "Content-Type": "application/json",
+    "Accept": "application/json",
+    "Host": "api.partner.market.yandex.ru",
+}
 
-def get_product_list(page, campaign_id, access_token):
+# Максимальное число товаров в одном запросе к API Маркета.
+CHUNK_PRICES = 500
+CHUNK_STOCKS = 2000
+
+# Маркет ограничивает число товаров в минуту: 10 000 для цен и 100 000 для
+# остатков, то есть 20 и 50 запросов в минуту при полных частях. Повтор
+# запроса учитывается в лимите как ещё один запрос.
+PRICES_LIMITER = AsyncRateLimiter(CONCURRENCY_LIMIT, rate=20)
+STOCKS_LIMITER = AsyncRateLimiter(CONCURRENCY_LIMIT, rate=50)
+
+
+@retry_on_throttle()
+async def get_product_list(session, page, campaign_id, access_token):
     """Получить информацию о размещённых товарах на Яндекс.Маркете.
 
     Args:
+        session (aiohttp.ClientSession): HTTP-сессия для запросов к API.
         page (str): Идентификатор страницы c результатами. Если не указан,
                     возвращается самая старая страница.
         campaign_id (int): Идентификатор кампании/магазина.
@@ -23,7 +57,7 @@ def get_product_list(page, campaign_id, access_token):
         dict: Информация о товарах в каталоге и пагинация.
 
     Examples:
-        > get_product_list("<PAGE_TOKEN>", "<CAMPAIGN>", "<API_TOKEN>")
+        > await get_product_list(session, "<PAGE_TOKEN>", "<CAMPAIGN>", "<API_TOKEN>")
         {
             "paging": {...},
             "offerMappingEntries": [{"offer": {...}, ...}, ...]
@@ -33,27 +67,24 @@ def get_product_list(page, campaign_id, access_token):
         https://yandex.ru/dev/market/partner-api/doc/ru/reference/offer-mappings/getOfferMappingEntries
     """
     endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
+    headers = {**MARKET_HEADERS, "Authorization": f"Bearer {access_token}"}
     payload = {
         "page_token": page,
         "limit": 200,
     }
     url = endpoint_url + f"campaigns/{campaign_id}/offer-mapping-entries"
-    response = requests.get(url, headers=headers, params=payload)
-    response.raise_for_status()
-    response_object = response.json()
+    async with session.get(url, headers=headers, params=payload) as response:
+        response.raise_for_status()
+        response_object = await response.json(loads=orjson.loads)
     return response_object.get("result")
 
 
-def update_stocks(stocks, campaign_id, access_token):
+@retry_on_throttle(STOCKS_LIMITER)
+async def update_stocks(session, stocks, campaign_id, access_token):
     """Обновить остатки товаров в магазине Яндекс.Маркета.
 
     Args:
+        session (aiohttp.ClientSession): HTTP-сессия для запросов к API.
         stocks (list of dict): Данные об остатках товаров.
         campaign_id (int): Идентификатор кампании/магазина.
         access_token (str): Токен доступа к API Яндекс.Маркета.
@@ -62,12 +93,14 @@ def update_stocks(stocks, campaign_id, access_token):
         dict: Статус выполнения запроса.
 
     Examples:
-        > update_stocks([{"sku": 12345, "items": [...], ...}, ...],
-                        "<CAMPAIGN>", "<API_TOKEN>")
+        > await update_stocks(session,
+                              [{"sku": 12345, "items": [...], ...}, ...],
+                              "<CAMPAIGN>", "<API_TOKEN>")
         {"status": "OK"}
 
-        > update_stocks([{"sku": <BAD_SKU>, "items": [...], ...}, ...],
-                        "<CAMPAIGN>", "<API_TOKEN>")
+        > await update_stocks(session,
+                              [{"sku": <BAD_SKU>, "items": [...], ...}, ...],
+                              "<CAMPAIGN>", "<API_TOKEN>")
         {
             "status": "OK",
             "errors": [{"code": "string", "message": "string"}]
@@ -77,24 +110,21 @@ def update_stocks(stocks, campaign_id, access_token):
         https://yandex.ru/dev/market/partner-api/doc/ru/reference/stocks/updateStocks
     """
     endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
+    headers = {**MARKET_HEADERS, "Authorization": f"Bearer {access_token}"}
     payload = {"skus": stocks}
     url = endpoint_url + f"campaigns/{campaign_id}/offers/stocks"
-    response = requests.put(url, headers=headers, json=payload)
-    response.raise_for_status()
-    response_object = response.json()
+    async with session.put(url, headers=headers, json=payload) as response:
+        response.raise_for_status()
+        response_object = await response.json(loads=orjson.loads)
     return response_object
 
 
-def update_price(prices, campaign_id, access_token):
+@retry_on_throttle(PRICES_LIMITER)
+async def update_price(session, prices, campaign_id, access_token):
     """Установить цены на товары в магазине Яндекс.Маркета.
 
     Args:
+        session (aiohttp.ClientSession): HTTP-сессия для запросов к API.
         prices (list of dict): Данные о ценах товаров.
         campaign_id (int): Идентификатор кампании/магазина.
         access_token (str): Токен доступа к API Яндекс.Маркета.
@@ -103,11 +133,12 @@ def update_price(prices, campaign_id, access_token):
         dict: Статус выполнения запроса.
 
     Examples:
-        > update_price([{"id": "12345", "price": {"value": 123, "currencyId": "RUR"}}, ...],
-                       "<CAMPAIGN>", "<API_TOKEN>")
+        > await update_price(session,
+                             [{"id": "12345", "price": {"value": 123, "currencyId": "RUR"}}, ...],
+                             "<CAMPAIGN>", "<API_TOKEN>")
         {"status": "OK"}
 
-        > update_price(<BAD_PRICES>, "<CAMPAIGN>", "<API_TOKEN>")
+        > await update_price(session, <BAD_PRICES>, "<CAMPAIGN>", "<API_TOKEN>")
         {
             "status": "OK",
             "errors": [{"code": "string", "message": "string"}]
@@ -117,24 +148,32 @@ def update_price(prices, campaign_id, access_token):
         https://yandex.ru/dev/market/partner-api/doc/ru/reference/assortment/updatePrices
     """
     endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
+    headers = {**MARKET_HEADERS, "Authorization": f"Bearer {access_token}"}
     payload = {"offers": prices}
     url = endpoint_url + f"campaigns/{campaign_id}/offer-prices/updates"
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    response_object = response.json()
+    async with session.post(url, headers=headers, json=payload) as response:
+        response.raise_for_status()
+        response_object = await response.json(loads=orjson.loads)
     return response_object
 
 
-def get_offer_ids(campaign_id, market_token):
+def is_accepted(response):
+    """Проверить, что Маркет принял все товары из запроса на обновление.
+
+    Examples:
+        >>> is_accepted({"status": "OK"})
+        True
+        >>> is_accepted({"status": "OK", "errors": [{"code": "string", "message": "string"}]})
+        False
+    """
+    return response.get("status") == "OK" and not response.get("errors")
+
+
+async def get_offer_ids(session, campaign_id, market_token):
     """Получить артикулы товаров Яндекс.Маркета.
 
     Args:
+        session (aiohttp.ClientSession): HTTP-сессия для запросов к API.
         campaign_id (int): Идентификатор кампании/магазина.
         access_token (str): Токен доступа к API Яндекс.Маркета.
 
@@ -142,10 +181,10 @@ def get_offer_ids(campaign_id, market_token):
         list of str: Список артикулов товаров, размещённых на Маркете.
 
     Examples:
-        > get_offer_ids("<CAMPAIGN>", "<API_TOKEN>")
+        > await get_offer_ids(session, "<CAMPAIGN>", "<API_TOKEN>")
         ["123", "234", ...]
 
-        > get_offer_ids("<BAD_CAMPAIGN>", "<OR_BAD_API_TOKEN>")
+        > await get_offer_ids(session, "<BAD_CAMPAIGN>", "<OR_BAD_API_TOKEN>")
         {
             "status": "OK",
             "errors": [{"code": "string", "message": "string"}]
@@ -154,7 +193,7 @@ def get_offer_ids(campaign_id, market_token):
     page = ""
     product_list = []
     while True:
-        some_prod = get_product_list(page, campaign_id, market_token)
+        some_prod = await get_product_list(session, page, campaign_id, market_token)
         product_list.extend(some_prod.get("offerMappingEntries"))
         page = some_prod.get("paging").get("nextPageToken")
         if not page:
@@ -169,148 +208,243 @@ def create_stocks(watch_remnants, offer_ids, warehouse_id):
     """Вернуть актуальные остатки для обновления товаров на Маркете.
 
     Args:
-        watch_remnants (list of dict): Текущие остатки товаров.
+        watch_remnants (pandas.DataFrame): Текущие остатки товаров.
         offer_ids (list of str): Товары, размещённые на Маркете.
         warehouse_id (int): Идентификатор склада.
 
     Returns:
-        list of dict: Список словарей с остатками для размещённых позиций.
+        tuple of (list of dict, list of dict): Пару значений: остатки с
+        ненулевым количеством и все остатки для размещённых позиций.
 
     Examples:
-        > create_stocks([{"Код": 69785, "Количество": 4, ...}, ...],
+        > create_stocks(pd.DataFrame([{"Код": "69785", "Количество": 4, ...}, ...]).set_index("Код"),
                         ["1234", "2345", ...], <WAREHOUSE_ID>)
-        [{"sku": "1234", "items": [...]}, ...]
+        ([{"sku": "1234", "items": [...]}, ...],
+         [{"sku": "1234", "items": [...]}, {"sku": "2345", "items": [...]}, ...])
     """
     # Уберем то, что не загружено в market
-    stocks = list()
-    date = str(datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z")
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            count = str(watch.get("Количество"))
-            if count == ">10":
-                stock = 100
-            elif count == "1":
-                stock = 0
-            else:
-                stock = int(watch.get("Количество"))
+    on_sale = watch_remnants[watch_remnants.index.isin(offer_ids)]
+    skus = on_sale.index.tolist()
+    counts = stocks_conversion(on_sale["Количество"]).tolist()
+    date = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    item = {"count": 0, "type": "FIT", "updatedAt": date}
+    stocks = []
+    not_empty = []
+    for sku, stock in zip(skus, counts):
+        watch_stock = {
+            "sku": sku,
+            "warehouseId": warehouse_id,
+            "items": [{**item, "count": stock}],
+        }
+        stocks.append(watch_stock)
+        if stock != 0:
+            not_empty.append(watch_stock)
+    # Добавим недостающее из загруженного:
+    uploaded = set(skus)
+    for offer_id in offer_ids:
+        if offer_id not in uploaded:
             stocks.append(
                 {
-                    "sku": str(watch.get("Код")),
+                    "sku": offer_id,
                     "warehouseId": warehouse_id,
-                    "items": [
-                        {
-                            "count": stock,
-                            "type": "FIT",
-                            "updatedAt": date,
-                        }
-                    ],
+                    "items": [item.copy()],
                 }
             )
-            offer_ids.remove(str(watch.get("Код")))
-    # Добавим недостающее из загруженного:
-    for offer_id in offer_ids:
-        stocks.append(
-            {
-                "sku": offer_id,
-                "warehouseId": warehouse_id,
-                "items": [
-                    {
-                        "count": 0,
-                        "type": "FIT",
-                        "updatedAt": date,
-                    }
-                ],
-            }
-        )
-    return stocks
+    return not_empty, stocks
 
 
 def create_prices(watch_remnants, offer_ids):
     """Вернуть актуальные цены для обновления товаров на Маркете.
 
     Args:
-        watch_remnants (list of dict): Текущие остатки товаров.
+        watch_remnants (pandas.DataFrame): Текущие остатки товаров.
         offer_ids (list of str): Товары, размещённые на Маркете.
 
     Returns:
         list of dict: Список словарей с ценами для размещённых позиций.
 
     Examples:
-        > create_prices([{"Код": 69785, "Количество": 4, ...}, ...]
+        > create_prices(pd.DataFrame([{"Код": "69785", "Количество": 4, ...}, ...]).set_index("Код"),
                         ["1234", "2345", ...])
         [{"id": "12345", "price": {"value": 123, "currencyId": "RUR"}}, ...]
     """
-    prices = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            price = {
-                "id": str(watch.get("Код")),
-                # "feed": {"id": 0},
-                "price": {
-                    "value": int(price_conversion(watch.get("Цена"))),
-                    # "discountBase": 0,
-                    "currencyId": "RUR",
-                    # "vat": 0,
-                },
-                # "marketSku": 0,
-                # "shopSku": "string",
-            }
-            prices.append(price)
-    return prices
+    on_sale = watch_remnants[watch_remnants.index.isin(offer_ids)]
+    prices = prices_conversion(on_sale["Цена"]).astype(int)
+    return [
+        {
+            "id": code,
+            # "feed": {"id": 0},
+            "price": {
+                "value": price,
+                # "discountBase": 0,
+                "currencyId": "RUR",
+                # "vat": 0,
+            },
+            # "marketSku": 0,
+            # "shopSku": "string",
+        }
+        for code, price in zip(on_sale.index.tolist(), prices.tolist())
+    ]
 
 
-async def upload_prices(watch_remnants, campaign_id, market_token):
+async def upload_prices(
+    session, watch_remnants, offer_ids, campaign_id, market_token, uploaded=None
+):
     """Обновляет цены размещённых на Маркете товаров из текущих остатков.
 
+    Выгружаются только цены, изменившиеся с прошлой выгрузки.
+
     Args:
-        watch_remnants (list of dict): текущие остатки товаров.
+        session (aiohttp.ClientSession): HTTP-сессия для запросов к API.
+        watch_remnants (pandas.DataFrame): текущие остатки товаров.
+        offer_ids (list of str): Товары, размещённые на Маркете.
         campaign_id (str): Идентификатор кампании/магазина.
         market_token (str): API-токен продавца на Маркете.
+        uploaded (dict): Выгруженные ранее цены по артикулам, дополняются
+                         ценами из частей, которые Маркет принял без ошибок.
+                         Если не указан, выгружаются все цены.
 
     Returns:
         list of dict: Список обновленных цен.
 
     Examples:
-        > upload_prices([{"Код": 69785, "Количество": 4, ...}, ...],
-                        "<CAMPAIGN_ID>", "<TOKEN>")
+        > upload_prices(session,
+                        pd.DataFrame([{"Код": "69785", "Количество": 4, ...}, ...]).set_index("Код"),
+                        ["1234", "2345", ...], "<CAMPAIGN_ID>", "<TOKEN>")
         [{"id": "12345", "price": {"value": 123, "currencyId": "RUR"}}, ...]
     """
-    offer_ids = get_offer_ids(campaign_id, market_token)
     prices = create_prices(watch_remnants, offer_ids)
-    for some_prices in list(divide(prices, 500)):
-        update_price(some_prices, campaign_id, market_token)
+    if uploaded is None:
+        uploaded = {}
+    forget_delisted(uploaded, offer_ids)
+    changed = [
+        price
+        for price in prices
+        if uploaded.get(price["id"]) != price["price"]["value"]
+    ]
+
+    async def upload(some_prices):
+        response = await update_price(session, some_prices, campaign_id, market_token)
+        if is_accepted(response):
+            uploaded.update(
+                (price["id"], price["price"]["value"]) for price in some_prices
+            )
+
+    await gather_or_cancel(
+        upload(some_prices) for some_prices in divide(changed, CHUNK_PRICES)
+    )
     return prices
 
 
-async def upload_stocks(watch_remnants, campaign_id, market_token, warehouse_id):
+async def upload_stocks(
+    session,
+    watch_remnants,
+    offer_ids,
+    campaign_id,
+    market_token,
+    warehouse_id,
+    uploaded=None,
+):
     """Обновляет остатки размещённых на Маркете товаров из текущих остатков.
 
+    Выгружаются только остатки, изменившиеся с прошлой выгрузки.
+
     Args:
-        watch_remnants (list of dict): текущие остатки товаров.
+        session (aiohttp.ClientSession): HTTP-сессия для запросов к API.
+        watch_remnants (pandas.DataFrame): текущие остатки товаров.
+        offer_ids (list of str): Товары, размещённые на Маркете.
         campaign_id (str): Идентификатор кампании/магазина.
         market_token (str): API-токен продавца на Маркете.
         warehouse_id (int): Идентификатор склада.
+        uploaded (dict): Выгруженные ранее остатки по артикулам, дополняются
+                         остатками из частей, которые Маркет принял без ошибок.
+                         Если не указан, выгружаются все остатки.
 
     Returns:
         tuple of (list of dict, list of dict): Пару значений: остатки с нулевым
         и ненулевым количеством.
 
     Examples:
-        > upload_stocks([{"Код": 69785, "Количество": 4, ...}, ...],
-                        "<CAMPAIGN_ID>", "<TOKEN>", <WAREHOUSE_ID>)
+        > upload_stocks(session,
+                        pd.DataFrame([{"Код": "69785", "Количество": 4, ...}, ...]).set_index("Код"),
+                        ["1234", "2345", ...], "<CAMPAIGN_ID>", "<TOKEN>",
+                        <WAREHOUSE_ID>)
         [{"sku": "1234", "items": [...]}, ...]
     """
-    offer_ids = get_offer_ids(campaign_id, market_token)
-    stocks = create_stocks(watch_remnants, offer_ids, warehouse_id)
-    for some_stock in list(divide(stocks, 2000)):
-        update_stocks(some_stock, campaign_id, market_token)
-    not_empty = list(
-        filter(lambda stock: (stock.get("items")[0].get("count") != 0), stocks)
+    not_empty, stocks = create_stocks(watch_remnants, offer_ids, warehouse_id)
+    if uploaded is None:
+        uploaded = {}
+    forget_delisted(uploaded, offer_ids)
+    changed = [
+        stock
+        for stock in stocks
+        if uploaded.get(stock["sku"]) != stock["items"][0]["count"]
+    ]
+
+    async def upload(some_stock):
+        response = await update_stocks(session, some_stock, campaign_id, market_token)
+        if is_accepted(response):
+            uploaded.update(
+                (stock["sku"], stock["items"][0]["count"]) for stock in some_stock
+            )
+
+    await gather_or_cancel(
+        upload(some_stock) for some_stock in divide(changed, CHUNK_STOCKS)
     )
     return not_empty, stocks
 
 
-def main():
+async def sync_campaign(
+    session, watch_remnants, campaign_id, market_token, warehouse_id, uploaded
+):
+    """Обновляет остатки и цены товаров одной кампании на Маркете.
+
+    Args:
+        session (aiohttp.ClientSession): HTTP-сессия для запросов к API.
+        watch_remnants (pandas.DataFrame): текущие остатки товаров.
+        campaign_id (str): Идентификатор кампании/магазина.
+        market_token (str): API-токен продавца на Маркете.
+        warehouse_id (int): Идентификатор склада.
+        uploaded (dict): Выгруженные ранее остатки и цены по разделам.
+    """
+    offer_ids = await get_offer_ids(session, campaign_id, market_token)
+    # Обновить остатки
+    await upload_stocks(
+        session,
+        watch_remnants,
+        offer_ids,
+        campaign_id,
+        market_token,
+        warehouse_id,
+        uploaded.setdefault(f"market:{campaign_id}:stocks", {}),
+    )
+    # Поменять цены
+    await upload_prices(
+        session,
+        watch_remnants,
+        offer_ids,
+        campaign_id,
+        market_token,
+        uploaded.setdefault(f"market:{campaign_id}:prices", {}),
+    )
+
+
+def print_campaign_error(error, campaign_id):
+    """Вывести ошибку обновления кампании по тем же правилам, что и в main.
+
+    Args:
+        error (Exception): Ошибка, с которой завершилось обновление кампании.
+        campaign_id (str): Идентификатор кампании/магазина.
+    """
+    if isinstance(error, asyncio.TimeoutError):
+        print(f"Кампания {campaign_id}: превышено время ожидания...")
+    elif isinstance(error, aiohttp.ClientConnectionError):
+        print(error, f"Ошибка соединения, кампания {campaign_id}")
+    else:
+        print(error, f"ERROR_2, кампания {campaign_id}")
+
+
+async def main():
     env = Env()
     market_token = env.str("MARKET_TOKEN")
     campaign_fbs_id = env.str("FBS_ID")
@@ -318,32 +452,46 @@ def main():
     warehouse_fbs_id = env.str("WAREHOUSE_FBS_ID")
     warehouse_dbs_id = env.str("WAREHOUSE_DBS_ID")
 
-    watch_remnants = download_stock()
+    uploaded = load_uploaded()
     try:
-        # FBS
-        offer_ids = get_offer_ids(campaign_fbs_id, market_token)
-        # Обновить остатки FBS
-        stocks = create_stocks(watch_remnants, offer_ids, warehouse_fbs_id)
-        for some_stock in list(divide(stocks, 2000)):
-            update_stocks(some_stock, campaign_fbs_id, market_token)
-        # Поменять цены FBS
-        upload_prices(watch_remnants, campaign_fbs_id, market_token)
-
-        # DBS
-        offer_ids = get_offer_ids(campaign_dbs_id, market_token)
-        # Обновить остатки DBS
-        stocks = create_stocks(watch_remnants, offer_ids, warehouse_dbs_id)
-        for some_stock in list(divide(stocks, 2000)):
-            update_stocks(some_stock, campaign_dbs_id, market_token)
-        # Поменять цены DBS
-        upload_prices(watch_remnants, campaign_dbs_id, market_token)
-    except requests.exceptions.ReadTimeout:
+        watch_remnants = download_stock()
+        async with create_api_session() as session:
+            # Кампании FBS и DBS не зависят друг от друга: ошибка в одной
+            # не прерывает другую, а сессия закрывается после обеих.
+            results = await asyncio.gather(
+                sync_campaign(
+                    session,
+                    watch_remnants,
+                    campaign_fbs_id,
+                    market_token,
+                    warehouse_fbs_id,
+                    uploaded,
+                ),
+                sync_campaign(
+                    session,
+                    watch_remnants,
+                    campaign_dbs_id,
+                    market_token,
+                    warehouse_dbs_id,
+                    uploaded,
+                ),
+                return_exceptions=True,
+            )
+            for campaign_id, result in zip((campaign_fbs_id, campaign_dbs_id), results):
+                if isinstance(result, Exception):
+                    print_campaign_error(result, campaign_id)
+    except (requests.exceptions.ReadTimeout, asyncio.TimeoutError):
         print("Превышено время ожидания...")
-    except requests.exceptions.ConnectionError as error:
+    except (
+        requests.exceptions.ConnectionError,
+        aiohttp.ClientConnectionError,
+    ) as error:
         print(error, "Ошибка соединения")
     except Exception as error:
         print(error, "ERROR_2")
+    finally:
+        save_uploaded(uploaded)
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -1,21 +1,198 @@
 """Работа с Ozon Seller API https://docs.ozon.ru/api/seller/"""
+import asyncio
+import collections
+import contextlib
+import email.utils
+import functools
 import io
 import logging.config
 import os
 import re
+import time
 import zipfile
 from environs import Env
 
+import aiohttp
+import orjson
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__file__)
 
+# Сколько запросов к API маркетплейса выполняется одновременно.
+CONCURRENCY_LIMIT = 4
 
-def get_product_list(last_id, client_id, seller_token):
+# Сколько запросов в минуту можно отправить в API Озона. Повторы запросов
+# тоже учитываются в этом лимите.
+RATE_LIMIT = 80
+
+# Окно в секундах, за которое API маркетплейсов считают запросы.
+RATE_PERIOD = 60
+
+# Повторы запросов, на которые API ответил 429 или 5xx: число попыток и
+# начальная задержка в секундах при 5xx, удваивающаяся с каждой попыткой.
+# При 429 запрос повторяется через Retry-After или через окно лимита.
+RETRY_ATTEMPTS = 5
+RETRY_BACKOFF = 1
+
+# Максимальное число товаров в одном запросе к API Озона.
+CHUNK_PRICES = 1000
+CHUNK_STOCKS = 100
+
+# Последние выгруженные остатки и цены: неизменившиеся позиции не выгружаются.
+UPLOADED_FILE = "uploaded.json"
+
+# Раз в сутки остатки и цены выгружаются целиком, чтобы исправить правки в
+# кабинете продавца и позиции, которые маркетплейс не принял.
+UPLOADED_MAX_AGE = 24 * 60 * 60
+
+# Всё, кроме цифр, удаляется из цены.
+NOT_DIGITS = re.compile("[^0-9]")
+
+
+class AsyncRateLimiter:
+    """Ограничитель частоты запросов к API.
+
+    Пропускает не больше concurrency запросов одновременно и не больше rate
+    запросов за period секунд. Используется как асинхронный контекстный
+    менеджер вокруг каждого запроса.
+
+    Examples:
+        > limiter = AsyncRateLimiter(concurrency=4, rate=80)
+        > async with limiter:
+        >     await session.post(url, json=payload, headers=headers)
+    """
+
+    def __init__(self, concurrency, rate, period=RATE_PERIOD):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.rate = rate
+        self.period = period
+        self.timestamps = collections.deque()
+        self.lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        try:
+            async with self.lock:
+                await self._wait_for_slot()
+        except BaseException:
+            self.semaphore.release()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.semaphore.release()
+
+    async def _wait_for_slot(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            while self.timestamps and now - self.timestamps[0] >= self.period:
+                self.timestamps.popleft()
+            if len(self.timestamps) < self.rate:
+                self.timestamps.append(now)
+                return
+            await asyncio.sleep(self.period - (now - self.timestamps[0]))
+
+
+def get_retry_delay(error, attempt, period=RATE_PERIOD):
+    """Вернуть, сколько секунд ждать перед повтором запроса к API.
+
+    Если API прислал Retry-After, ждём сколько сказано. Иначе при 429 ждём
+    целое окно лимита, а при 5xx — экспоненциально растущую задержку.
+
+    Args:
+        error (aiohttp.ClientResponseError): Ошибка ответа API.
+        attempt (int): Номер неудавшейся попытки, начиная с 0.
+        period (float): Окно лимита запросов в секундах.
+
+    Returns:
+        float: Задержка в секундах.
+
+    Examples:
+        >>> def error(status, headers=None):
+        ...     return aiohttp.ClientResponseError(None, (), status=status, headers=headers)
+        >>> get_retry_delay(error(429, {"Retry-After": "7"}), 0)
+        7.0
+        >>> get_retry_delay(error(429), 0)
+        60
+        >>> get_retry_delay(error(503), 2)
+        4
+    """
+    retry_after = (error.headers or {}).get("Retry-After")
+    if retry_after:
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            pass
+        try:
+            retry_at = email.utils.parsedate_to_datetime(retry_after)
+            return max(retry_at.timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            pass
+    if error.status == 429:
+        return period
+    return RETRY_BACKOFF * 2**attempt
+
+
+def retry_on_throttle(limiter=None):
+    """Повторять запрос к API с задержкой при 429 и 5xx.
+
+    Каждая попытка отдельно проходит через limiter, поэтому повторы тоже
+    учитываются в лимите API, а на время задержки место в нём освобождается.
+    Задержку выбирает get_retry_delay: после 429 повтор ждёт окно limiter,
+    чтобы не израсходовать все попытки внутри той же минуты.
+
+    Args:
+        limiter (AsyncRateLimiter): Ограничитель частоты запросов к API. Если
+            не указан, попытки не ограничиваются.
+
+    Returns:
+        function: Декоратор для функции запроса, бросающей
+        aiohttp.ClientResponseError при ошибочном статусе ответа.
+
+    Examples:
+        > @retry_on_throttle(STOCKS_LIMITER)
+        > async def update_stocks(session, stocks, client_id, seller_token):
+        >     ...
+    """
+    period = RATE_PERIOD
+    if limiter is None:
+        limiter = contextlib.nullcontext()
+    else:
+        period = limiter.period
+
+    def decorator(request):
+        @functools.wraps(request)
+        async def wrapper(*args, **kwargs):
+            for attempt in range(RETRY_ATTEMPTS):
+                try:
+                    async with limiter:
+                        return await request(*args, **kwargs)
+                except aiohttp.ClientResponseError as error:
+                    retryable = error.status == 429 or error.status >= 500
+                    if not retryable or attempt == RETRY_ATTEMPTS - 1:
+                        raise
+                    logger.warning("%s, повтор запроса %s", error, request.__name__)
+                    await asyncio.sleep(get_retry_delay(error, attempt, period))
+
+        return wrapper
+
+    return decorator
+
+
+PRICES_LIMITER = AsyncRateLimiter(CONCURRENCY_LIMIT, RATE_LIMIT)
+STOCKS_LIMITER = AsyncRateLimiter(CONCURRENCY_LIMIT, RATE_LIMIT)
+
+
+@retry_on_throttle()
+async def get_product_list(session, last_id, client_id, seller_token):
     """Получить список товаров магазина Озон.
 
     Args:
+        session (aiohttp.ClientSession): HTTP-сессия для запросов к API.
         last_id (str): Идентификатор последнего значения на странице.
         client_id (str): Идентификатор продавца.
         seller_token (str): API-токен продавца.
@@ -26,11 +203,11 @@ def get_product_list(last_id, client_id, seller_token):
 
     Examples:
         # Первый запрос, last_id неизвестен, оставляем пустым:
-        > get_product_list('', '<CLIENT_ID>', '<TOKEN>')
+        > await get_product_list(session, '', '<CLIENT_ID>', '<TOKEN>')
         {"items": [{"product_id": 223681945, "offer_id": "136748"}, ...]}
 
         # Используем полученный last_id для следующего запроса:
-        > get_product_list('bnVсbA==', '<CLIENT_ID>', '<TOKEN>')
+        > await get_product_list(session, 'bnVсbA==', '<CLIENT_ID>', '<TOKEN>')
         {"items": [{"product_id": 12345, "offer_id": "23455"}, ...]}
 
     .. _Ozon Seller API:
@@ -48,16 +225,20 @@ def get_product_list(last_id, client_id, seller_token):
         "last_id": last_id,
         "limit": 1000,
     }
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
-    response_object = response.json()
+    async with session.post(url, json=payload, headers=headers) as response:
+        response.raise_for_status()
+        response_object = await response.json(loads=orjson.loads)
     return response_object.get("result")
 
 
-def get_offer_ids(client_id, seller_token):
+async def get_offer_ids(session, client_id, seller_token):
     """Получить артикулы товаров, размещённых на Озоне.
 
+    Озон отдаёт страницы по курсору last_id, поэтому они загружаются по
+    очереди.
+
     Args:
+        session (aiohttp.ClientSession): HTTP-сессия для запросов к API.
         client_id (str): Идентификатор продавца.
         seller_token (str): API-токен продавца.
 
@@ -65,17 +246,17 @@ def get_offer_ids(client_id, seller_token):
         list of str: Список артикулов товаров (offer_id), опубликованных в Озоне.
 
     Examples:
-        > get_offer_ids("<CLIENT_ID>", "<TOKEN>")
+        > await get_offer_ids(session, "<CLIENT_ID>", "<TOKEN>")
         ["136748", "136749", ...]
     """
     last_id = ""
     product_list = []
     while True:
-        some_prod = get_product_list(last_id, client_id, seller_token)
-        product_list.extend(some_prod.get("items"))
-        total = some_prod.get("total")
+        some_prod = await get_product_list(session, last_id, client_id, seller_token)
+        items = some_prod.get("items")
+        product_list.extend(items)
         last_id = some_prod.get("last_id")
-        if total == len(product_list):
+        if not items or len(product_list) >= some_prod.get("total"):
             break
     offer_ids = []
     for product in product_list:
@@ -83,10 +264,12 @@ def get_offer_ids(client_id, seller_token):
     return offer_ids
 
 
-def update_price(prices: list, client_id, seller_token):
+@retry_on_throttle(PRICES_LIMITER)
+async def update_price(session, prices: list, client_id, seller_token):
     """Обновить цены товаров, размещённых на Озоне.
 
     Args:
+        session (aiohttp.ClientSession): HTTP-сессия для запросов к API.
         prices (list of str): Цены товаров для обновления.
         client_id (str): Идентификатор продавца.
         seller_token (str): API-токен продавца.
@@ -95,7 +278,8 @@ def update_price(prices: list, client_id, seller_token):
         dict: Ответ сервера после обновления цен.
 
     Example:
-        > update_prices(
+        > await update_price(
+            session,
             [{
               "auto_action_enabled": "UNKNOWN",
               "currency_code": "RUB",
@@ -123,15 +307,17 @@ def update_price(prices: list, client_id, seller_token):
         "Api-Key": seller_token,
     }
     payload = {"prices": prices}
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
-    return response.json()
+    async with session.post(url, json=payload, headers=headers) as response:
+        response.raise_for_status()
+        return await response.json(loads=orjson.loads)
 
 
-def update_stocks(stocks: list, client_id, seller_token):
+@retry_on_throttle(STOCKS_LIMITER)
+async def update_stocks(session, stocks: list, client_id, seller_token):
     """Обновить остатки товаров, размещённых на Озоне.
 
     Args:
+        session (aiohttp.ClientSession): HTTP-сессия для запросов к API.
         stocks (list of str): Остатки товаров для обновления.
         client_id (str): Идентификатор продавца.
         seller_token (str): API-токен продавца.
@@ -140,7 +326,8 @@ def update_stocks(stocks: list, client_id, seller_token):
         dict: Ответ сервера после обновления остатков.
 
     Examples:
-        > update_stocks(
+        > await update_stocks(
+            session,
             [{
                   "offer_id": "PG-2404С1",
                   "product_id": 55946,
@@ -165,86 +352,143 @@ def update_stocks(stocks: list, client_id, seller_token):
         "Api-Key": seller_token,
     }
     payload = {"stocks": stocks}
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
-    return response.json()
+    async with session.post(url, json=payload, headers=headers) as response:
+        response.raise_for_status()
+        return await response.json(loads=orjson.loads)
+
+
+def load_uploaded(path=UPLOADED_FILE, max_age=UPLOADED_MAX_AGE):
+    """Загрузить последние выгруженные на маркетплейсы остатки и цены.
+
+    Args:
+        path (str): Путь к файлу с выгруженными значениями.
+        max_age (int): Через сколько секунд после полной выгрузки всё
+                       выгружается заново.
+
+    Returns:
+        dict: Время полной выгрузки и выгруженные значения по разделам,
+        например {"synced_at": 1700000000.0,
+        "ozon:<CLIENT_ID>:stocks": {"136748": 3, ...}, ...}. Без разделов,
+        если выгрузок ещё не было, файл повреждён или устарел.
+    """
+    try:
+        with open(path, "rb") as file:
+            uploaded = orjson.loads(file.read())
+    except FileNotFoundError:
+        uploaded = {}
+    except orjson.JSONDecodeError as error:
+        logger.warning("Файл %s повреждён, выгружаем всё заново: %s", path, error)
+        uploaded = {}
+    if time.time() - uploaded.get("synced_at", 0) > max_age:
+        uploaded = {"synced_at": time.time()}
+    return uploaded
+
+
+def save_uploaded(uploaded, path=UPLOADED_FILE):
+    """Сохранить выгруженные на маркетплейсы остатки и цены.
+
+    Файл сначала пишется во временный и только потом подменяет старый, чтобы
+    прерванный запуск не оставил его обрезанным.
+
+    Args:
+        uploaded (dict): Выгруженные значения по разделам.
+        path (str): Путь к файлу с выгруженными значениями.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(orjson.dumps(uploaded))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
 
 
 def download_stock():
-    """Вернуть остатки с сайта Casio в виде словаря.
+    """Вернуть остатки с сайта Casio в виде таблицы.
 
-    Скачивает Excel-таблицу и преобразует её в словарь.
+    Скачивает Excel-таблицу и загружает её в DataFrame.
 
     Returns:
-        dict: Остатки товаров с ценами и количеством.
+        pandas.DataFrame: Остатки товаров с ценами и количеством,
+        проиндексированные по коду товара.
 
     Examples:
         > download_stock()
-        [{
-            "Код": 69785,
-            "Количество": 4,
-            "Цена": "5'990.00 руб.",
-            ...
-        }, ...]
+              Количество           Цена
+        Код
+        69785          4  5'990.00 руб.
+        ...
     """
     # Скачать остатки с сайта
     casio_url = "https://timeworld.ru/upload/files/ostatki.zip"
-    session = requests.Session()
-    response = session.get(casio_url)
+    # Повторять только GET при сбоях сайта
+    retry = Retry(
+        total=5,
+        backoff_factor=0.3,
+        status_forcelist=(429, 500, 502, 503, 504),
+        raise_on_status=False,
+    )
+    with requests.Session() as session:
+        session.mount("https://", HTTPAdapter(max_retries=retry))
+        response = session.get(casio_url)
     response.raise_for_status()
+    # Создаем таблицу остатков часов, не распаковывая архив на диск:
     with response, zipfile.ZipFile(io.BytesIO(response.content)) as archive:
-        archive.extractall(".")
-    # Создаем список остатков часов:
-    excel_file = "ostatki.xls"
-    watch_remnants = pd.read_excel(
-        io=excel_file,
-        na_values=None,
-        keep_default_na=False,
-        header=17,
-    ).to_dict(orient="records")
-    os.remove("./ostatki.xls")  # Удалить файл
-    return watch_remnants
+        with archive.open("ostatki.xls") as excel_file:
+            watch_remnants = pd.read_excel(
+                io=excel_file,
+                engine="calamine",
+                na_values=None,
+                keep_default_na=False,
+                header=17,
+                usecols=["Код", "Количество", "Цена"],
+                dtype={"Код": str},
+                index_col="Код",
+            )
+    # Один раз убрать повторы кодов, а не в каждом create_stocks/create_prices
+    return watch_remnants[~watch_remnants.index.duplicated()]
 
 
 def create_stocks(watch_remnants, offer_ids):
     """Вернуть актуальные остатки для товаров на Озоне.
 
     Args:
-        watch_remnants (list of dict): текущие остатки товаров.
+        watch_remnants (pandas.DataFrame): текущие остатки товаров.
         offer_ids (list of str): товары, размещённые на Озоне.
 
     Returns:
-        list of dict: Список словарей с остатками для размещённых позиций.
+        tuple of (list of dict, list of dict): Пару значений: остатки с
+        ненулевым количеством и все остатки для размещённых позиций.
 
     Examples:
-        > create_stocks([{"Код": 69785, "Количество": 4, ...}, ...]
+        > create_stocks(pd.DataFrame([{"Код": "69785", "Количество": 4, ...}, ...]).set_index("Код"),
                         ["136748", "136749", ...])
-        [{"offer_id": "136748", "stock": 3}, ...]
+        ([{"offer_id": "136748", "stock": 3}, ...],
+         [{"offer_id": "136748", "stock": 3}, {"offer_id": "136749", "stock": 0}, ...])
     """
     # Уберем то, что не загружено в seller
+    on_sale = watch_remnants[watch_remnants.index.isin(offer_ids)]
+    skus = on_sale.index.tolist()
+    counts = stocks_conversion(on_sale["Количество"]).tolist()
     stocks = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            count = str(watch.get("Количество"))
-            if count == ">10":
-                stock = 100
-            elif count == "1":
-                stock = 0
-            else:
-                stock = int(watch.get("Количество"))
-            stocks.append({"offer_id": str(watch.get("Код")), "stock": stock})
-            offer_ids.remove(str(watch.get("Код")))
+    not_empty = []
+    for sku, stock in zip(skus, counts):
+        watch_stock = {"offer_id": sku, "stock": stock}
+        stocks.append(watch_stock)
+        if stock != 0:
+            not_empty.append(watch_stock)
     # Добавим недостающее из загруженного:
+    uploaded = set(skus)
     for offer_id in offer_ids:
-        stocks.append({"offer_id": offer_id, "stock": 0})
-    return stocks
+        if offer_id not in uploaded:
+            stocks.append({"offer_id": offer_id, "stock": 0})
+    return not_empty, stocks
 
 
 def create_prices(watch_remnants, offer_ids):
     """Вернуть актуальные цены для товаров на Озоне.
 
     Args:
-        watch_remnants (list of str): текущие остатки товаров.
+        watch_remnants (pandas.DataFrame): текущие остатки товаров.
         offer_ids (list of str): товары, размещённые на Озоне.
 
     Returns:
@@ -252,7 +496,7 @@ def create_prices(watch_remnants, offer_ids):
                       Озоне товаров.
 
     Examples:
-        > create_prices([{"Код": 69785, "Цена": "5'990.00 руб.", ...}, ...]
+        > create_prices(pd.DataFrame([{"Код": "69785", "Цена": "5'990.00 руб.", ...}, ...]).set_index("Код"),
                         ["136748", "136749", ...])
         [{
           "auto_action_enabled": "UNKNOWN",
@@ -262,18 +506,51 @@ def create_prices(watch_remnants, offer_ids):
           "price": "5990",
         }, ... ]
     """
-    prices = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            price = {
-                "auto_action_enabled": "UNKNOWN",
-                "currency_code": "RUB",
-                "offer_id": str(watch.get("Код")),
-                "old_price": "0",
-                "price": price_conversion(watch.get("Цена")),
-            }
-            prices.append(price)
-    return prices
+    on_sale = watch_remnants[watch_remnants.index.isin(offer_ids)]
+    prices = prices_conversion(on_sale["Цена"])
+    return [
+        {
+            "auto_action_enabled": "UNKNOWN",
+            "currency_code": "RUB",
+            "offer_id": code,
+            "old_price": "0",
+            "price": price,
+        }
+        for code, price in zip(on_sale.index.tolist(), prices.tolist())
+    ]
+
+
+def stocks_conversion(counts):
+    """Преобразовать количество из таблицы остатков в остатки на маркетплейсе.
+
+    Args:
+        counts (pandas.Series): Колонка «Количество» из таблицы остатков.
+
+    Returns:
+        pandas.Series: Остатки в виде целых чисел.
+
+    Examples:
+        >>> stocks_conversion(pd.Series([">10", 1, 4, "7"])).tolist()
+        [100, 0, 4, 7]
+    """
+    counts = counts.astype(str).replace({">10": "100", "1": "0"})
+    return pd.to_numeric(counts).astype(int)
+
+
+def prices_conversion(prices):
+    """Преобразовать колонку с ценами в строки с целыми числами.
+
+    Args:
+        prices (pandas.Series): Колонка «Цена» из таблицы остатков.
+
+    Returns:
+        pandas.Series: Цены в виде строк без копеек и прочих символов.
+
+    Examples:
+        >>> prices_conversion(pd.Series(["5'990.00 руб.", "5990", "руб."])).tolist()
+        ['5990', '5990', '']
+    """
+    return prices.astype(str).map(price_conversion)
 
 
 def price_conversion(price: str) -> str:
@@ -297,7 +574,39 @@ def price_conversion(price: str) -> str:
         ...
         AttributeError: 'int' object has no attribute 'split'
     """
-    return re.sub("[^0-9]", "", price.split(".")[0])
+    return NOT_DIGITS.sub("", price.split(".", 1)[0])
+
+
+def get_updated_offer_ids(response):
+    """Вернуть артикулы, обновление которых Озон подтвердил в ответе.
+
+    Examples:
+        >>> sorted(get_updated_offer_ids({"result": [
+        ...     {"offer_id": "PH8865", "updated": True, "errors": []},
+        ...     {"offer_id": "PH8866", "updated": False, "errors": [{"code": "NOT_FOUND"}]},
+        ... ]}))
+        ['PH8865']
+    """
+    return {
+        item.get("offer_id")
+        for item in response.get("result") or []
+        if item.get("updated") and not item.get("errors")
+    }
+
+
+def forget_delisted(uploaded, offer_ids):
+    """Убрать из выгруженных значений товары, снятые с маркетплейса.
+
+    Если товар разместят снова, его остаток и цена выгрузятся заново.
+
+    Examples:
+        >>> uploaded = {"136748": 3, "136749": 0}
+        >>> forget_delisted(uploaded, ["136748"])
+        >>> uploaded
+        {'136748': 3}
+    """
+    for offer_id in uploaded.keys() - set(offer_ids):
+        del uploaded[offer_id]
 
 
 def divide(lst: list, n: int):
@@ -318,26 +627,82 @@ def divide(lst: list, n: int):
         yield lst[i: i + n]
 
 
-async def upload_prices(watch_remnants, client_id, seller_token):
+def json_dumps(obj):
+    """Сериализовать объект в JSON-строку с помощью orjson.
+
+    Examples:
+        >>> json_dumps({"offer_id": "136748", "stock": 3})
+        '{"offer_id":"136748","stock":3}'
+    """
+    return orjson.dumps(obj).decode()
+
+
+def create_api_session():
+    """Создать HTTP-сессию для запросов к API маркетплейсов.
+
+    Сессия держит пул соединений и кэширует DNS, поэтому её стоит открывать
+    один раз и передавать во все запросы. Тела запросов сериализуются orjson.
+
+    Returns:
+        aiohttp.ClientSession: Новая HTTP-сессия.
+    """
+    connector = aiohttp.TCPConnector(limit=64, limit_per_host=16, ttl_dns_cache=300)
+    return aiohttp.ClientSession(connector=connector, json_serialize=json_dumps)
+
+
+async def gather_or_cancel(coros):
+    """Выполнить корутины конкурентно.
+
+    Частоту запросов ограничивают сами функции запросов, см. retry_on_throttle.
+    Если одна из корутин упала, остальные отменяются и дожидаются завершения,
+    чтобы ни одна не продолжила работу с уже закрытой сессией.
+
+    Args:
+        coros (iterable of coroutine): Корутины для выполнения.
+
+    Returns:
+        list: Результаты корутин в порядке их передачи.
+    """
+    tasks = [asyncio.create_task(coro) for coro in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def upload_prices(
+    session, watch_remnants, offer_ids, client_id, seller_token, uploaded=None
+):
     """Обновляет цены размещённых на Озоне товаров из текущих остатков.
 
+    Выгружаются только цены, изменившиеся с прошлой выгрузки.
+
     Args:
-        watch_remnants (list of dict): текущие остатки товаров.
+        session (aiohttp.ClientSession): HTTP-сессия для запросов к API.
+        watch_remnants (pandas.DataFrame): текущие остатки товаров.
+        offer_ids (list of str): товары, размещённые на Озоне.
         client_id (str): Идентификатор продавца.
         seller_token (str): API-токен продавца.
+        uploaded (dict): Выгруженные ранее цены по артикулам, дополняются
+                         ценами, которые Озон подтвердил. Если не указан,
+                         выгружаются все цены.
 
     Returns:
         list of dict: Список словарей для обновлённых цен.
 
     Examples:
         > upload_prices(
-            [{
-                "Код": 69785,
+            session,
+            pd.DataFrame([{
+                "Код": "69785",
                 "Количество": 4,
                 "Цена": "5'990.00 руб.",
                 ...
             }, ...
-            ], "<CLIENT_ID>", "<TOKEN>")
+            ]).set_index("Код"), ["136748", "136749", ...], "<CLIENT_ID>", "<TOKEN>")
 
         [{
           "auto_action_enabled": "UNKNOWN",
@@ -347,20 +712,45 @@ async def upload_prices(watch_remnants, client_id, seller_token):
           "price": "1448",
         }, ... ]
     """
-    offer_ids = get_offer_ids(client_id, seller_token)
     prices = create_prices(watch_remnants, offer_ids)
-    for some_price in list(divide(prices, 1000)):
-        update_price(some_price, client_id, seller_token)
+    if uploaded is None:
+        uploaded = {}
+    forget_delisted(uploaded, offer_ids)
+    changed = [
+        price for price in prices if uploaded.get(price["offer_id"]) != price["price"]
+    ]
+
+    async def upload(some_price):
+        response = await update_price(session, some_price, client_id, seller_token)
+        updated = get_updated_offer_ids(response)
+        uploaded.update(
+            (price["offer_id"], price["price"])
+            for price in some_price
+            if price["offer_id"] in updated
+        )
+
+    await gather_or_cancel(
+        upload(some_price) for some_price in divide(changed, CHUNK_PRICES)
+    )
     return prices
 
 
-async def upload_stocks(watch_remnants, client_id, seller_token):
+async def upload_stocks(
+    session, watch_remnants, offer_ids, client_id, seller_token, uploaded=None
+):
     """Обновляет количество размещённых на Озоне товаров из текущих остатков.
 
+    Выгружаются только остатки, изменившиеся с прошлой выгрузки.
+
     Args:
-        watch_remnants (list of dict): текущие остатки товаров.
+        session (aiohttp.ClientSession): HTTP-сессия для запросов к API.
+        watch_remnants (pandas.DataFrame): текущие остатки товаров.
+        offer_ids (list of str): товары, размещённые на Озоне.
         client_id (str): Идентификатор продавца.
         seller_token (str): API-токен продавца.
+        uploaded (dict): Выгруженные ранее остатки по артикулам, дополняются
+                         остатками, которые Озон подтвердил. Если не указан,
+                         выгружаются все остатки.
 
     Returns:
         tuple of (list of dict, list of dict): Пару значений: остатки с нулевым
@@ -368,13 +758,14 @@ async def upload_stocks(watch_remnants, client_id, seller_token):
 
     Examples:
         > upload_prices(
-            [{
-                "Код": 69785,
+            session,
+            pd.DataFrame([{
+                "Код": "69785",
                 "Количество": 4,
                 "Цена": "5'990.00 руб.",
                 ...
             }, ...
-            ], "<CLIENT_ID>", "<TOKEN>")
+            ]).set_index("Код"), ["136748", "136749", ...], "<CLIENT_ID>", "<TOKEN>")
 
         [{
           "auto_action_enabled": "UNKNOWN",
@@ -384,36 +775,68 @@ async def upload_stocks(watch_remnants, client_id, seller_token):
           "price": "1448",
         }, ... ],
     """
-    offer_ids = get_offer_ids(client_id, seller_token)
-    stocks = create_stocks(watch_remnants, offer_ids)
-    for some_stock in list(divide(stocks, 100)):
-        update_stocks(some_stock, client_id, seller_token)
-    not_empty = list(filter(lambda stock: (stock.get("stock") != 0), stocks))
+    not_empty, stocks = create_stocks(watch_remnants, offer_ids)
+    if uploaded is None:
+        uploaded = {}
+    forget_delisted(uploaded, offer_ids)
+    changed = [
+        stock for stock in stocks if uploaded.get(stock["offer_id"]) != stock["stock"]
+    ]
+
+    async def upload(some_stock):
+        response = await update_stocks(session, some_stock, client_id, seller_token)
+        updated = get_updated_offer_ids(response)
+        uploaded.update(
+            (stock["offer_id"], stock["stock"])
+            for stock in some_stock
+            if stock["offer_id"] in updated
+        )
+
+    await gather_or_cancel(
+        upload(some_stock) for some_stock in divide(changed, CHUNK_STOCKS)
+    )
     return not_empty, stocks
 
 
-def main():
+async def main():
     env = Env()
     seller_token = env.str("SELLER_TOKEN")
     client_id = env.str("CLIENT_ID")
+    uploaded = load_uploaded()
     try:
-        offer_ids = get_offer_ids(client_id, seller_token)
-        watch_remnants = download_stock()
-        # Обновить остатки
-        stocks = create_stocks(watch_remnants, offer_ids)
-        for some_stock in list(divide(stocks, 100)):
-            update_stocks(some_stock, client_id, seller_token)
-        # Поменять цены
-        prices = create_prices(watch_remnants, offer_ids)
-        for some_price in list(divide(prices, 900)):
-            update_price(some_price, client_id, seller_token)
-    except requests.exceptions.ReadTimeout:
+        async with create_api_session() as session:
+            offer_ids = await get_offer_ids(session, client_id, seller_token)
+            watch_remnants = download_stock()
+            # Обновить остатки
+            await upload_stocks(
+                session,
+                watch_remnants,
+                offer_ids,
+                client_id,
+                seller_token,
+                uploaded.setdefault(f"ozon:{client_id}:stocks", {}),
+            )
+            # Поменять цены
+            await upload_prices(
+                session,
+                watch_remnants,
+                offer_ids,
+                client_id,
+                seller_token,
+                uploaded.setdefault(f"ozon:{client_id}:prices", {}),
+            )
+    except (requests.exceptions.ReadTimeout, asyncio.TimeoutError):
         print("Превышено время ожидания...")
-    except requests.exceptions.ConnectionError as error:
+    except (
+        requests.exceptions.ConnectionError,
+        aiohttp.ClientConnectionError,
+    ) as error:
         print(error, "Ошибка соединения")
     except Exception as error:
         print(error, "ERROR_2")
+    finally:
+        save_uploaded(uploaded)
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())